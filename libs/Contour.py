@@ -252,7 +252,7 @@ def calculate_external_energy(source, WLine, WEdge):
     # EEdge *= 255 / EEdge.max()
     # EEdge = EEdge.astype("int16")
 
-    return WLine * ELine + WEdge * EEdge[1:-1, 1:-1]
+    return WLine * ELine + WEdge * EEdge
 
 
 def main():
@@ -1,17 +1,33 @@
 import cv2
 import numpy as np
-from scipy.signal import convolve2d
+from numba import njit, prange
 
-from libs.LowPass import gaussian_filter
 
+def convolve(gray: np.ndarray, kernel):
+    """
+        Convolve a float32 gray scale image with a kernel
+        :param gray: Image to convolve
+        :param kernel: 2-D kernel array, or (row, column) tuple of the 1-D factors of a separable kernel
+        :return: The result of convolution
+    """
+    # filter2D & sepFilter2D compute correlation, so flip the kernels first
+    if isinstance(kernel, tuple):
+        row_kernel, column_kernel = kernel
+        return cv2.sepFilter2D(gray, cv2.CV_32F,
+                               np.flip(row_kernel).astype(np.float32, copy=False),
+                               np.flip(column_kernel).astype(np.float32, copy=False),
+                               borderType=cv2.BORDER_REPLICATE)
 
-def apply_kernel(source: np.ndarray, horizontal_kernel: np.ndarray, vertical_kernel: np.ndarray,
-                 ReturnEdge: bool = False):
+    kernel = cv2.flip(kernel.astype(np.float32, copy=False), -1)
+    return cv2.filter2D(gray, cv2.CV_32F, kernel, borderType=cv2.BORDER_REPLICATE)
+
+
+def apply_kernel(source: np.ndarray, horizontal_kernel, vertical_kernel, ReturnEdge: bool = False):
     """
         Convert image to gray scale and convolve with kernels
         :param source: Image to apply kernel to
-        :param horizontal_kernel: The horizontal array of the kernel
-        :param vertical_kernel: The vertical array of the kernel
+        :param horizontal_kernel: The horizontal array of the kernel, or its (row, column) 1-D factors
+        :param vertical_kernel: The vertical array of the kernel, or its (row, column) 1-D factors
         :param ReturnEdge: Return Horizontal & Vertical Edges
         :return: The result of convolution
     """
@@ -21,11 +37,12 @@ def apply_kernel(source: np.ndarray, horizontal_kernel: np.ndarray, vertical_ker
     else:
         gray = source
 
-    # convolution
-    horizontal_edge = convolve2d(gray, horizontal_kernel)
-    vertical_edge = convolve2d(gray, vertical_kernel)
+    # convolution (separable kernels are applied as two 1-D passes)
+    gray = gray.astype(np.float32, copy=False)
+    horizontal_edge = convolve(gray, horizontal_kernel)
+    vertical_edge = convolve(gray, vertical_kernel)
 
-    mag = np.sqrt(pow(horizontal_edge, 2.0) + pow(vertical_edge, 2.0))
+    mag = np.hypot(horizontal_edge, vertical_edge)
     if ReturnEdge:
         return mag, horizontal_edge, vertical_edge
     return mag
@@ -33,19 +50,36 @@ def apply_kernel(source: np.ndarray, horizontal_kernel: np.ndarray, vertical_ker
 
 def prewitt_edge(source: np.ndarray):
     """
-        Apply Prewitt Operator to detect edges
+        Apply Prewitt Operator to detect edges, as two 1-D passes per direction
         :param source: Image to detect edges in
         :return: edges image
     """
     # define filters
-    vertical = np.array([[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]])
-    horizontal = np.array([[-1, -1, -1], [0, 0, 0], [1, 1, 1]])
+    # vertical = [[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]] = [1, 1, 1].T @ [-1, 0, 1]
+    # horizontal = [[-1, -1, -1], [0, 0, 0], [1, 1, 1]] = [-1, 0, 1].T @ [1, 1, 1]
+    vertical = (np.array([-1, 0, 1], dtype=np.float32), np.array([1, 1, 1], dtype=np.float32))
+    horizontal = (np.array([1, 1, 1], dtype=np.float32), np.array([-1, 0, 1], dtype=np.float32))
 
     mag = apply_kernel(source, horizontal, vertical)
 
     return mag
 
 
+def sobel_edge_separable(source: np.ndarray, ReturnEdge: bool = False):
+    """
+        Apply Sobel Operator as two 1-D passes per direction
+        :param source: Image to detect edges in
+        :param ReturnEdge: Return Horizontal & Vertical Edges
+        :return: edges image
+    """
+    # horizontal = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]] = [1, 2, 1].T @ [-1, 0, 1]
+    # vertical = np.flip(horizontal.T) = [1, 0, -1].T @ [1, 2, 1]
+    horizontal = (np.array([-1, 0, 1], dtype=np.float32), np.array([1, 2, 1], dtype=np.float32))
+    vertical = (np.array([1, 2, 1], dtype=np.float32), np.array([1, 0, -1], dtype=np.float32))
+
+    return apply_kernel(source, horizontal, vertical, ReturnEdge)
+
+
 def sobel_edge(source: np.ndarray, GetMagnitude: bool = True, GetDirection: bool = False):
     """
         Apply Sobel Operator to detect edges
@@ -54,15 +88,7 @@ def sobel_edge(source: np.ndarray, GetMagnitude: bool = True, GetDirection: bool
         :param GetDirection: Get Gradient direction in Pi Terms
         :return: edges image
     """
-    # define filters
-    # vertical = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-    # horizontal = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
-    horizontal = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-    vertical = np.flip(horizontal.T)
-    mag, HorizontalEdge, VerticalEdge = apply_kernel(source, horizontal, vertical, True)
-
-    HorizontalEdge = HorizontalEdge[:-2, :-2]
-    VerticalEdge = VerticalEdge[:-2, :-2]
+    mag, HorizontalEdge, VerticalEdge = sobel_edge_separable(source, ReturnEdge=True)
 
     if GetMagnitude == False:
         return HorizontalEdge, VerticalEdge
@@ -81,8 +107,8 @@ def roberts_edge(source: np.ndarray):
         :return: edges image
     """
     # define filters
-    vertical = np.array([[0, 1], [-1, 0]])
-    horizontal = np.array([[1, 0], [0, -1]])
+    vertical = np.array([[0, 1], [-1, 0]], dtype=np.float32)
+    horizontal = np.array([[1, 0], [0, -1]], dtype=np.float32)
 
     mag = apply_kernel(source, horizontal, vertical)
 
@@ -99,7 +125,9 @@ def canny_edge(source: np.ndarray):
     Gray = cv2.cvtColor(source, cv2.COLOR_RGB2GRAY)
 
     # Apply Gaussian Filter
-    FilteredImage = gaussian_filter(Gray, 3, 9)
+    # (equivalent, not identical, to LowPass.gaussian_filter(Gray, 3, 9): its 8x8 kernel spans ±3 std -> sigma = 4/3,
+    # but it was shifted by half a pixel and truncated to uint8, so the outputs differ by a few gray levels)
+    FilteredImage = cv2.GaussianBlur(Gray, (9, 9), sigmaX=4 / 3)
 
     # Get Gradient Magnitude & Direction
     GradientMagnitude, GradientDirection = sobel_edge(FilteredImage, GetMagnitude=True, GetDirection=True)
@@ -117,6 +145,23 @@ def canny_edge(source: np.ndarray):
     return CannyEdges
 
 
+def _direction_bin(angle: float) -> int:
+    """
+    Quantize a direction in degrees into the Non-Maximum Suppression bins 0°, 45°, 90°, 135° -> 0, 1, 2, 3
+    """
+    return int(((angle % 180) + 22.5) / 45) % 4
+
+
+# Direction bin of every half degree in [0, 360), the bins edges are multiples of 22.5° so no precision is lost
+NMS_BIN_LUT = np.array([_direction_bin(angle / 2) for angle in range(720)], dtype=np.uint8)
+
+# (row, col) offsets of the before & after neighbours for each direction bin
+NMS_OFFSETS = np.array([[0, -1, 0, 1],      # 0°
+                        [1, -1, -1, 1],     # 45°
+                        [-1, 0, 1, 0],      # 90°
+                        [-1, -1, 1, 1]])    # 135°
+
+
 def NonMaximumSuppression(GradientMagnitude: np.ndarray, GradientDirection: np.ndarray):
     """
     Applies Non-Maximum Suppressed Gradient Image To Thin Out The Edges
@@ -124,39 +169,32 @@ def NonMaximumSuppression(GradientMagnitude: np.ndarray, GradientDirection: np.n
     :param GradientDirection: Direction of The Image's Edges
     :return Non-Maximum Suppressed Image:
     """
-    M, N = GradientMagnitude.shape
-    SuppressedImage = np.zeros(GradientMagnitude.shape)
-
     # Convert Rad Directions To Degree
-    GradientDirection = np.rad2deg(GradientDirection)
-    GradientDirection += 180
-    PI = 180
+    GradientDirection = (np.rad2deg(GradientDirection) + 180).astype(np.float32)
+
+    return _non_maximum_suppression(GradientMagnitude.astype(np.float32, copy=False), GradientDirection)
 
-    for row in range(1, M - 1):
+
+@njit(parallel=True, cache=True)
+def _non_maximum_suppression(GradientMagnitude, GradientDirection):
+    """
+    Compiled Non-Maximum Suppression loop
+    :param GradientMagnitude: Gradient Image To Thin Out It's Edges
+    :param GradientDirection: Direction of The Image's Edges in Degrees [0, 360]
+    :return Non-Maximum Suppressed Image:
+    """
+    M, N = GradientMagnitude.shape
+    SuppressedImage = np.zeros(GradientMagnitude.shape, dtype=GradientMagnitude.dtype)
+
+    for row in prange(1, M - 1):
         for col in range(1, N - 1):
-            try:
-                direction = GradientDirection[row, col]
-                # 0°
-                if (0 <= direction < PI / 8) or (15 * PI / 8 <= direction <= 2 * PI):
-                    before_pixel = GradientMagnitude[row, col - 1]
-                    after_pixel = GradientMagnitude[row, col + 1]
-                # 45°
-                elif (PI / 8 <= direction < 3 * PI / 8) or (9 * PI / 8 <= direction < 11 * PI / 8):
-                    before_pixel = GradientMagnitude[row + 1, col - 1]
-                    after_pixel = GradientMagnitude[row - 1, col + 1]
-                # 90°
-                elif (3 * PI / 8 <= direction < 5 * PI / 8) or (11 * PI / 8 <= direction < 13 * PI / 8):
-                    before_pixel = GradientMagnitude[row - 1, col]
-                    after_pixel = GradientMagnitude[row + 1, col]
-                # 135°
-                else:
-                    before_pixel = GradientMagnitude[row - 1, col - 1]
-                    after_pixel = GradientMagnitude[row + 1, col + 1]
-
-                if GradientMagnitude[row, col] >= before_pixel and GradientMagnitude[row, col] >= after_pixel:
-                    SuppressedImage[row, col] = GradientMagnitude[row, col]
-            except IndexError as e:
-                pass
+            # Look up The Direction Bin & Its Neighbours
+            direction_bin = NMS_BIN_LUT[int(GradientDirection[row, col] * 2) % 720]
+            before_pixel = GradientMagnitude[row + NMS_OFFSETS[direction_bin, 0], col + NMS_OFFSETS[direction_bin, 1]]
+            after_pixel = GradientMagnitude[row + NMS_OFFSETS[direction_bin, 2], col + NMS_OFFSETS[direction_bin, 3]]
+
+            if GradientMagnitude[row, col] >= before_pixel and GradientMagnitude[row, col] >= after_pixel:
+                SuppressedImage[row, col] = GradientMagnitude[row, col]
 
     return SuppressedImage
 
@@ -180,35 +218,74 @@ def DoubleThreshold(Image, LowThreshold, HighThreshold, Weak, isRatio=True):
         High = HighThreshold
         Low = LowThreshold
 
-    # Create Empty Array
-    ThresholdedImage = np.zeros(Image.shape)
+    # Create Empty Array, values are only 0, Weak or Strong
+    ThresholdedImage = np.zeros(Image.shape, dtype=np.uint8)
 
     Strong = 255
-    # Find Position of Strong & Weak Pixels
-    StrongRow, StrongCol = np.where(Image >= High)
-    WeakRow, WeakCol = np.where((Image <= High) & (Image >= Low))
+    # Find Strong & Weak Pixels
+    StrongMask = Image >= High
+    WeakMask = (Image >= Low) & ~StrongMask
 
     # Apply Thresholding
-    ThresholdedImage[StrongRow, StrongCol] = Strong
-    ThresholdedImage[WeakRow, WeakCol] = Weak
+    ThresholdedImage[StrongMask] = Strong
+    ThresholdedImage[WeakMask] = Weak
 
     return ThresholdedImage
 
 
 def Hysteresis(Image, Weak=70, Strong=255):
+    """
+    Apply Hysteresis To Keep Weak Pixels Connected To Strong Ones
+    :param Image: Double Thresholded Image
+    :param Weak: Pixel Value of Weak Pixels
+    :param Strong: Pixel Value of Strong Pixels
+    :return: Image With Only Strong Edges
+    """
+    return _hysteresis(Image, Weak, Strong)
+
+
+@njit(cache=True)
+def _promote_weak_pixels(Image, Weak, Strong, Reverse):
+    """
+    Single raster pass promoting weak pixels that touch a strong pixel, border pixels included
+    :return: True if any pixel was promoted
+    """
+    M, N = Image.shape
+    Changed = False
+    for r in range(M):
+        i = M - 1 - r if Reverse else r
+        for c in range(N):
+            j = N - 1 - c if Reverse else c
+            if Image[i, j] != Weak:
+                continue
+            # 8-neighbourhood clipped to the image bounds
+            Promoted = False
+            for ni in range(max(i - 1, 0), min(i + 2, M)):
+                for nj in range(max(j - 1, 0), min(j + 2, N)):
+                    if Image[ni, nj] == Strong:
+                        Promoted = True
+                        break
+                if Promoted:
+                    break
+            if Promoted:
+                Image[i, j] = Strong
+                Changed = True
+    return Changed
+
+
+@njit(cache=True)
+def _hysteresis(Image, Weak, Strong):
+    """
+    Compiled Hysteresis, alternates forward & reverse passes until no weak pixel is promoted
+    """
+    Reverse = False
+    while _promote_weak_pixels(Image, Weak, Strong, Reverse):
+        Reverse = not Reverse
+
+    # Remaining weak pixels are not connected to any strong edge
     M, N = Image.shape
-    for i in range(1, M - 1):
-        for j in range(1, N - 1):
+    for i in range(M):
+        for j in range(N):
             if Image[i, j] == Weak:
-                try:
-                    if ((Image[i + 1, j - 1] == Strong) or (Image[i + 1, j] == Strong) or (
-                            Image[i + 1, j + 1] == Strong)
-                            or (Image[i, j - 1] == Strong) or (Image[i, j + 1] == Strong)
-                            or (Image[i - 1, j - 1] == Strong) or (Image[i - 1, j] == Strong) or (
-                                    Image[i - 1, j + 1] == Strong)):
-                        Image[i, j] = Strong
-                    else:
-                        Image[i, j] = 0
-                except IndexError as e:
-                    pass
+                Image[i, j] = 0
     return Image
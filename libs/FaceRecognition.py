@@ -1,9 +1,11 @@
 import glob
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
-from sklearn import preprocessing
+from scipy.spatial import cKDTree
 
 
 class FaceRecognizer:
@@ -18,6 +20,9 @@ class FaceRecognizer:
         self.A_tilde = None                          # A_tilda Matrix
         self.eigenfaces = None                       # EigenFaces Matrix
         self.eigenfaces_num = 350                    # number of chosen eigenfaces
+        self.chosen_eigenfaces = None                # Contiguous copy of the chosen eigenfaces
+        self.projections = None                      # Dataset images represented in the eigenfaces space
+        self.projections_tree = None                 # KD-Tree of the projections for nearest neighbour search
 
     def create_images_matrix(self) -> tuple:
         """
@@ -25,36 +30,39 @@ class FaceRecognizer:
         :return:
         """
 
-        for images in glob.glob(self.dataset_path + '/**', recursive=True):
-            if images[-3:] == 'pgm' or images[-3:] == 'jpg':
-                self.total_images += 1
+        images_paths = list()
 
-        # initialize the numpy array
-        self.all_images = np.zeros((self.total_images, self.img_shape[0], self.img_shape[1]), dtype='float64')
-        i = 0
-
-        # iterate through all the class
+        # iterate through all the class, collecting the images paths in a single pass
         for folder in glob.glob(self.dataset_path + '/*'):
             self.classes_num += 1
 
-            # makes 10 copy of each class name in the list (since we have 10 images in each class)
-            for _ in range(10):
-                # list for the classes of the faces
-                self.names.append(folder[-3:].replace('/', ''))
+            folder_images = [image for image in glob.glob(folder + '/*') if image[-3:] in ('pgm', 'jpg')]
+            images_paths.extend(folder_images)
 
-            # iterate through each folder (class)
-            for image in glob.glob(folder + '/*'):
+            # a copy of the class name for each image in the class (10 images in each class)
+            self.names.extend([folder[-3:].replace('/', '')] * len(folder_images))
 
-                # read the image in grayscale
-                read_image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        self.total_images = len(images_paths)
+
+        # initialize the numpy array
+        self.all_images = np.empty((self.total_images, self.img_shape[0], self.img_shape[1]), dtype=np.float32)
 
-                # cv2.resize resizes an image into (# column x # height)
-                resized_image = cv2.resize(read_image, (self.img_shape[1], self.img_shape[0]))
-                self.all_images[i] = np.array(resized_image)
-                i += 1
+        # decode the images in parallel (cv2 releases the GIL while reading and resizing)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(self._load_image, range(self.total_images), images_paths))
 
         return self.classes_num, self.total_images, self.img_shape
 
+    def _load_image(self, i: int, image_path: str):
+        """
+        Read an image in grayscale and store it resized in row i of the images matrix
+        :param i: Row index in the images matrix
+        :param image_path: Path of the image
+        """
+        # cv2.resize resizes an image into (# column x # height)
+        self.all_images[i] = cv2.resize(cv2.imread(image_path, cv2.IMREAD_GRAYSCALE),
+                                        (self.img_shape[1], self.img_shape[0]))
+
     def fit(self):
         """
 
@@ -62,30 +70,26 @@ class FaceRecognizer:
         """
 
         # convert the images into vectors. Each row has an image vector. i.e. samples x image_vector matrix
-        a = np.resize(self.all_images, (self.total_images, self.img_shape[0] * self.img_shape[1]))
+        a = self.all_images.reshape(self.total_images, -1)
 
         # calculate the mean vector
-        self.mean_vector = np.sum(a, axis=0, dtype='float64') / self.total_images
+        self.mean_vector = a.mean(axis=0, dtype=np.float32)
 
-        # make a 400 copy of the same vector. 400 x image_vector_size matrix.
-        mean_matrix = np.tile(self.mean_vector, (self.total_images, 1))
-
-        # mean-subtracted image vectors
-        self.A_tilde = a - mean_matrix
+        # mean-subtracted image vectors (the mean vector is broadcast over the 400 rows)
+        self.A_tilde = a - self.mean_vector
 
         # since each row is an image vector
         # (unlike in the notes, L = (A_tilde)(A_tilde.T) instead of L = (A_tilde.T)(A_tilde)
         L = (self.A_tilde.dot(self.A_tilde.T)) / self.total_images
 
         # find the eigenvalues and the eigenvectors of L
-        eigenvalues, eigenvectors = np.linalg.eig(L)
-
-        # get the indices of the eigenvalues by its value. Descending order.
-        idx = eigenvalues.argsort()[::-1]
+        # L is symmetric, so eigh gives real eigenvalues/eigenvectors sorted in ascending order
+        eigenvalues, eigenvectors = np.linalg.eigh(L)
 
         # sorted eigenvalues and eigenvectors in descending order
-        # eigenvalues = eigenvalues[idx]
-        eigenvectors = eigenvectors[:, idx]
+        # (contiguous copy of the reversed view, so the following matmul runs as a plain real GEMM)
+        # eigenvalues = eigenvalues[::-1]
+        eigenvectors = np.ascontiguousarray(eigenvectors[:, ::-1])
 
         # linear combination of each column of A_tilde
         eigenvectors_c = self.A_tilde.T @ eigenvectors
@@ -93,9 +97,21 @@ class FaceRecognizer:
         # each column is an eigenvector of C where C = (A_tilde.T)(A_tilde).
         # NOTE : in the notes, C = (A_tilde)(A_tilde.T)
 
-        # normalize the eigenvectors
-        # normalize only accepts matrix with n_samples, n_feature. Hence the transpose.
-        self.eigenfaces = preprocessing.normalize(eigenvectors_c.T)
+        # normalize the eigenvectors, each row of the transpose is an eigenface
+        eigenfaces = np.ascontiguousarray(eigenvectors_c.T)
+        norms = np.linalg.norm(eigenfaces, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        eigenfaces /= norms
+        self.eigenfaces = eigenfaces
+
+        # cache the chosen eigenfaces contiguously so the queries matmul don't copy them on every call
+        self.chosen_eigenfaces = np.ascontiguousarray(self.eigenfaces[:self.eigenfaces_num])
+
+        # the vectors that represent the dataset images with respect to the eigenfaces. Each column is an omega_k.
+        self.projections = np.ascontiguousarray(self.chosen_eigenfaces @ self.A_tilde.T)
+
+        # index the omega_k vectors for the nearest neighbour search of recognize_face
+        self.projections_tree = cKDTree(self.projections.T)
 
         return self.eigenfaces_num
 
@@ -114,21 +130,20 @@ class FaceRecognizer:
         # resize the testing image. cv2 resize by width and height.
         test_img = cv2.resize(test_img, (self.img_shape[1], self.img_shape[0]))
 
-        # subtract the mean
-        mean_subtracted_test_img = np.reshape(test_img, (test_img.shape[0] * test_img.shape[1])) - self.mean_vector
+        # subtract the mean (in place, on a float32 copy of the image vector)
+        mean_subtracted_test_img = test_img.astype(np.float32).ravel()
+        mean_subtracted_test_img -= self.mean_vector
 
         # the vector that represents the image with respect to the eigenfaces.
-        omega = self.eigenfaces[:self.eigenfaces_num].dot(mean_subtracted_test_img)
+        omega = self.chosen_eigenfaces.dot(mean_subtracted_test_img)
 
         # chosen threshold for face detection
         alpha_1 = 3000
 
-        # n^2 vector of the new face image represented as the linear combination of the chosen eigenfaces
-        projected_new_img_vector = self.eigenfaces[:self.eigenfaces_num].T @ omega
-        diff = mean_subtracted_test_img - projected_new_img_vector
-
-        # distance between the original face image vector and the projected vector.
-        beta = math.sqrt(diff.dot(diff))
+        # distance between the original face image vector and its projection on the chosen eigenfaces.
+        # the eigenfaces are orthonormal, so ||x - E.T @ omega||^2 = x.x - omega.omega
+        # (clamped at zero against round-off)
+        beta = math.sqrt(max(0.0, mean_subtracted_test_img.dot(mean_subtracted_test_img) - omega.dot(omega)))
 
         if beta < alpha_1:
             print(f"Face detected in the image!, beta = {beta}")
@@ -153,29 +168,17 @@ class FaceRecognizer:
         # resize the testing image. cv2 resize by width and height.
         test_img = cv2.resize(test_img, (self.img_shape[1], self.img_shape[0]))
 
-        # subtract the mean
-        mean_subtracted_test_img = np.reshape(test_img, (test_img.shape[0] * test_img.shape[1])) - self.mean_vector
+        # subtract the mean (in place, on a float32 copy of the image vector)
+        mean_subtracted_test_img = test_img.astype(np.float32).ravel()
+        mean_subtracted_test_img -= self.mean_vector
 
         # the vector that represents the image with respect to the eigenfaces.
-        omega = self.eigenfaces[:self.eigenfaces_num].dot(mean_subtracted_test_img)
+        omega = self.chosen_eigenfaces.dot(mean_subtracted_test_img)
 
         alpha_2 = 3000              # chosen threshold for face recognition
-        smallest_value = None       # to keep track of the smallest value
-        index = None                # to keep track of the class that produces the smallest value
-
-        for k in range(self.total_images):
-            # calculate the vectors of the images in the dataset and represent
-            omega_k = self.eigenfaces[:self.eigenfaces_num].dot(self.A_tilde[k])
-            diff = omega - omega_k
-            epsilon_k = math.sqrt(diff.dot(diff))
-
-            if smallest_value is None:
-                smallest_value = epsilon_k
-                index = k
-
-            if smallest_value > epsilon_k:
-                smallest_value = epsilon_k
-                index = k
+
+        # the smallest distance between omega and the dataset vectors omega_k, and the class that produces it
+        smallest_value, index = self.projections_tree.query(omega, k=1)
 
         if smallest_value < alpha_2:
             face_name = self.names[index]